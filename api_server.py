@@ -1,15 +1,21 @@
 
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
+from fastapi.responses import FileResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional
+import aiofiles
+import aiofiles.os
+import asyncio
+import orjson
+import redis.asyncio
 import uvicorn
 import os
+import time
 import uuid
-import shutil
 import logging
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import json
 
@@ -29,7 +35,71 @@ app = FastAPI(
     version="1.0.0"
 )
 
-# Add CORS middleware
+# Configuration
+UPLOAD_DIR = "/tmp/uploads"
+OUTPUT_DIR = "/tmp/outputs"
+RESULTS_DIR = "/tmp/results"
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 2 * 1024 ** 3))
+ANALYZER_CONCURRENCY = int(os.getenv("ANALYZER_CONCURRENCY", 2))
+
+# Worker pool for CPU-bound analysis; the semaphore queues background tasks
+# once all workers are busy instead of oversubscribing the pool
+PROCESS_POOL = ProcessPoolExecutor(max_workers=ANALYZER_CONCURRENCY)
+analysis_semaphore = asyncio.Semaphore(ANALYZER_CONCURRENCY)
+
+
+class MaxBodySizeMiddleware:
+    """
+    ASGI middleware that rejects request bodies larger than max_bytes.
+
+    Requests declaring an oversized Content-Length are refused with 413
+    before any body is read; chunked bodies are counted as they stream in
+    and cut off at the threshold.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and int(content_length) > self.max_bytes:
+            await send({
+                "type": "http.response.start",
+                "status": 413,
+                "headers": [(b"content-type", b"application/json")]
+            })
+            await send({
+                "type": "http.response.body",
+                "body": b'{"detail":"Request body too large"}'
+            })
+            return
+
+        bytes_received = 0
+
+        async def limited_receive():
+            nonlocal bytes_received
+            message = await receive()
+            if message["type"] == "http.request":
+                bytes_received += len(message.get("body", b""))
+                if bytes_received > self.max_bytes:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"Request body exceeds maximum size of {self.max_bytes} bytes"
+                    )
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+app.add_middleware(MaxBodySizeMiddleware, max_bytes=MAX_UPLOAD_BYTES)
+
+# Add CORS middleware after the size limiter so it wraps it (last added is
+# outermost) and both 413 paths carry CORS headers
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -38,18 +108,43 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Configuration
-UPLOAD_DIR = "/tmp/uploads"
-OUTPUT_DIR = "/tmp/outputs"
-RESULTS_DIR = "/tmp/results"
-
 # Create directories if they don't exist
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 os.makedirs(RESULTS_DIR, exist_ok=True)
 
-# In-memory storage for analysis jobs (in production, use Redis or database)
-analysis_jobs = {}
+# Redis-backed job store, shared across uvicorn workers; entries expire
+# after JOB_TTL_SECONDS to match the on-disk cleanup window
+JOB_TTL_SECONDS = 86400
+
+redis_client = redis.asyncio.Redis.from_url(
+    os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+    decode_responses=True
+)
+
+
+def _job_key(job_id: str) -> str:
+    return f"job:{job_id}"
+
+
+async def save_job(job_id: str, fields: dict):
+    """Persist job fields to Redis, JSON-encoding nested values"""
+    mapping = {
+        k: json.dumps(v) if isinstance(v, (dict, list)) else v
+        for k, v in fields.items()
+    }
+    await redis_client.hset(_job_key(job_id), mapping=mapping)
+    await redis_client.expire(_job_key(job_id), JOB_TTL_SECONDS)
+
+
+async def load_job(job_id: str) -> Optional[dict]:
+    """Fetch a job from Redis, decoding the nested results field"""
+    job = await redis_client.hgetall(_job_key(job_id))
+    if not job:
+        return None
+    if 'results' in job:
+        job['results'] = json.loads(job['results'])
+    return job
 
 
 class AnalysisRequest(BaseModel):
@@ -80,59 +175,80 @@ class JobStatus(BaseModel):
 def cleanup_old_files(directory: str, max_age_hours: int = 24):
     """Clean up files older than specified hours"""
     try:
-        current_time = datetime.now().timestamp()
-        for filename in os.listdir(directory):
-            filepath = os.path.join(directory, filename)
-            if os.path.isfile(filepath):
-                file_age = current_time - os.path.getmtime(filepath)
-                if file_age > (max_age_hours * 3600):
-                    os.remove(filepath)
-                    logger.info(f"Cleaned up old file: {filename}")
+        cutoff = time.time() - max_age_hours * 3600
+        # scandir returns DirEntry objects with cached stat data, so this
+        # costs one syscall per file instead of listdir + stat per path
+        for entry in os.scandir(directory):
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                logger.info(f"Cleaned up old file: {entry.name}")
     except Exception as e:
         logger.error(f"Error during cleanup: {e}")
 
 
+async def _janitor(interval_seconds: int = int(os.getenv("CLEANUP_INTERVAL_SECONDS", 3600))):
+    """Periodically clear expired files from the working directories"""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        for directory in (UPLOAD_DIR, OUTPUT_DIR, RESULTS_DIR):
+            # The sweep does blocking filesystem work; keep it off the loop
+            await asyncio.to_thread(cleanup_old_files, directory)
+
+
+@app.on_event("startup")
+async def start_janitor():
+    # Keep a strong reference so the task isn't garbage-collected mid-flight
+    app.state.janitor_task = asyncio.create_task(_janitor())
+
+
 async def process_video_analysis(
     job_id: str,
     input_path: str,
     output_path: str,
+    keypoints_path: str,
     min_detection_confidence: float,
     min_tracking_confidence: float
 ):
     """Background task to process video analysis"""
     try:
-        logger.info(f"Starting analysis for job {job_id}")
-        
-        # Update job status
-        analysis_jobs[job_id]['status'] = 'processing'
-        
-        # Perform analysis
-        results = analyze_dance_video(
-            input_path,
-            output_path,
-            min_detection_confidence=min_detection_confidence,
-            min_tracking_confidence=min_tracking_confidence
-        )
+        async with analysis_semaphore:
+            logger.info(f"Starting analysis for job {job_id}")
+
+            # Update job status
+            await redis_client.hset(_job_key(job_id), 'status', 'processing')
+
+            # Run the CPU-bound analysis in a worker process so the event
+            # loop stays free to serve other requests
+            results = await asyncio.get_running_loop().run_in_executor(
+                PROCESS_POOL,
+                analyze_dance_video,
+                input_path,
+                output_path,
+                min_detection_confidence,
+                min_tracking_confidence,
+                keypoints_path
+            )
         
         # Save results to file
         results_path = os.path.join(RESULTS_DIR, f"{job_id}_results.json")
-        with open(results_path, 'w') as f:
-            json.dump(results, f, indent=2)
+        with open(results_path, 'wb') as f:
+            f.write(orjson.dumps(results, option=orjson.OPT_SERIALIZE_NUMPY))
         
         # Update job status
-        analysis_jobs[job_id].update({
+        await save_job(job_id, {
             'status': 'completed',
             'completed_at': datetime.now().isoformat(),
             'results': results,
             'output_video_path': output_path,
-            'results_path': results_path
+            'results_path': results_path,
+            'keypoints_path': keypoints_path
         })
-        
+
         logger.info(f"Analysis completed for job {job_id}")
-        
+
     except Exception as e:
         logger.error(f"Error processing job {job_id}: {e}")
-        analysis_jobs[job_id].update({
+        await save_job(job_id, {
             'status': 'failed',
             'completed_at': datetime.now().isoformat(),
             'error': str(e)
@@ -150,6 +266,7 @@ async def root():
             "status": "/api/v1/status/{job_id}",
             "download": "/api/v1/download/{job_id}",
             "results": "/api/v1/results/{job_id}",
+            "keypoints": "/api/v1/keypoints/{job_id}",
             "health": "/health"
         }
     }
@@ -158,59 +275,78 @@ async def root():
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
+    active_jobs = 0
+    async for key in redis_client.scan_iter(match="job:*"):
+        if await redis_client.hget(key, 'status') == 'processing':
+            active_jobs += 1
+
     return {
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
-        "active_jobs": len([j for j in analysis_jobs.values() if j['status'] == 'processing'])
+        "active_jobs": active_jobs
     }
 
 
 @app.post("/api/v1/analyze", response_model=AnalysisResponse)
 async def analyze_video(
+    request: Request,
     background_tasks: BackgroundTasks,
-    video: UploadFile = File(...),
+    filename: str,
     min_detection_confidence: float = 0.5,
     min_tracking_confidence: float = 0.5
 ):
-    
+
     # Validate file type
     allowed_extensions = ['.mp4', '.avi', '.mov', '.MP4', '.AVI', '.MOV']
-    file_ext = os.path.splitext(video.filename)[1]
-    
+    file_ext = os.path.splitext(filename)[1]
+
     if file_ext not in allowed_extensions:
         raise HTTPException(
             status_code=400,
             detail=f"Invalid file type. Allowed: {', '.join(allowed_extensions)}"
         )
-    
+
     # Generate unique job ID
     job_id = str(uuid.uuid4())
-    
-    # Save uploaded file
+
+    # Stream the raw request body straight to disk in chunks, so large
+    # uploads are never spooled to a temporary file or buffered in memory
     input_filename = f"{job_id}_input{file_ext}"
     input_path = os.path.join(UPLOAD_DIR, input_filename)
-    
+
+    bytes_received = 0
     try:
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
-        
-        logger.info(f"Video uploaded for job {job_id}: {video.filename}")
+        # Size limits are enforced by MaxBodySizeMiddleware, which raises
+        # the 413 from inside request.stream()
+        async with aiofiles.open(input_path, "wb") as buffer:
+            async for chunk in request.stream():
+                bytes_received += len(chunk)
+                await buffer.write(chunk)
+
+        logger.info(f"Video uploaded for job {job_id}: {filename} ({bytes_received} bytes)")
+    except HTTPException:
+        if os.path.exists(input_path):
+            os.remove(input_path)
+        raise
     except Exception as e:
+        if os.path.exists(input_path):
+            os.remove(input_path)
         raise HTTPException(status_code=500, detail=f"Error saving file: {e}")
     
-    # Prepare output path
+    # Prepare output paths
     output_filename = f"{job_id}_output.mp4"
     output_path = os.path.join(OUTPUT_DIR, output_filename)
+    keypoints_path = os.path.join(RESULTS_DIR, f"{job_id}_keypoints.parquet")
     
     # Create job record
-    analysis_jobs[job_id] = {
+    await save_job(job_id, {
         'job_id': job_id,
         'status': 'queued',
         'created_at': datetime.now().isoformat(),
-        'input_filename': video.filename,
+        'input_filename': filename,
         'input_path': input_path,
         'output_path': output_path
-    }
+    })
     
     # Start background processing
     background_tasks.add_task(
@@ -218,15 +354,12 @@ async def analyze_video(
         job_id,
         input_path,
         output_path,
+        keypoints_path,
         min_detection_confidence,
         min_tracking_confidence
     )
-    
-    # Clean up old files
-    background_tasks.add_task(cleanup_old_files, UPLOAD_DIR)
-    background_tasks.add_task(cleanup_old_files, OUTPUT_DIR)
-    background_tasks.add_task(cleanup_old_files, RESULTS_DIR)
-    
+
+
     return AnalysisResponse(
         job_id=job_id,
         status="queued",
@@ -237,12 +370,12 @@ async def analyze_video(
 
 @app.get("/api/v1/status/{job_id}", response_model=JobStatus)
 async def get_job_status(job_id: str):
-    
-    if job_id not in analysis_jobs:
+
+    job = await load_job(job_id)
+
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    
-    job = analysis_jobs[job_id]
-    
+
     response = JobStatus(
         job_id=job_id,
         status=job['status'],
@@ -259,13 +392,13 @@ async def get_job_status(job_id: str):
 
 
 @app.get("/api/v1/download/{job_id}")
-async def download_video(job_id: str):
-    
-    if job_id not in analysis_jobs:
+async def download_video(job_id: str, request: Request):
+
+    job = await load_job(job_id)
+
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    
-    job = analysis_jobs[job_id]
-    
+
     if job['status'] != 'completed':
         raise HTTPException(
             status_code=400,
@@ -273,25 +406,35 @@ async def download_video(job_id: str):
         )
     
     output_path = job.get('output_path')
-    
+
     if not output_path or not os.path.exists(output_path):
         raise HTTPException(status_code=404, detail="Output video not found")
-    
+
+    # Passing stat_result lets FileResponse use the kernel sendfile path;
+    # the ETag lets repeat downloads short-circuit with 304
+    st = os.stat(output_path)
+    etag = f'"{int(st.st_mtime)}-{st.st_size}"'
+
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304)
+
     return FileResponse(
         output_path,
         media_type="video/mp4",
-        filename=f"analyzed_{job_id}.mp4"
+        filename=f"analyzed_{job_id}.mp4",
+        stat_result=st,
+        headers={"ETag": etag}
     )
 
 
 @app.get("/api/v1/results/{job_id}")
-async def get_results(job_id: str):
-    
-    if job_id not in analysis_jobs:
+async def get_results(job_id: str, request: Request):
+
+    job = await load_job(job_id)
+
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    
-    job = analysis_jobs[job_id]
-    
+
     if job['status'] != 'completed':
         raise HTTPException(
             status_code=400,
@@ -299,39 +442,81 @@ async def get_results(job_id: str):
         )
     
     results_path = job.get('results_path')
-    
+
     if not results_path or not os.path.exists(results_path):
         # Return inline results if file not found
         return job.get('results', {})
-    
+
+    st = os.stat(results_path)
+    etag = f'"{int(st.st_mtime)}-{st.st_size}"'
+
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304)
+
     return FileResponse(
         results_path,
         media_type="application/json",
-        filename=f"results_{job_id}.json"
+        filename=f"results_{job_id}.json",
+        stat_result=st,
+        headers={"ETag": etag}
+    )
+
+
+@app.get("/api/v1/keypoints/{job_id}")
+async def get_keypoints(job_id: str, request: Request):
+
+    job = await load_job(job_id)
+
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    if job['status'] != 'completed':
+        raise HTTPException(
+            status_code=400,
+            detail=f"Analysis not completed. Current status: {job['status']}"
+        )
+
+    keypoints_path = job.get('keypoints_path')
+
+    if not keypoints_path or not os.path.exists(keypoints_path):
+        raise HTTPException(status_code=404, detail="Keypoints file not found")
+
+    st = os.stat(keypoints_path)
+    etag = f'"{int(st.st_mtime)}-{st.st_size}"'
+
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304)
+
+    return FileResponse(
+        keypoints_path,
+        media_type="application/vnd.apache.parquet",
+        filename=f"keypoints_{job_id}.parquet",
+        stat_result=st,
+        headers={"ETag": etag}
     )
 
 
 @app.delete("/api/v1/jobs/{job_id}")
 async def delete_job(job_id: str):
-    
-    if job_id not in analysis_jobs:
+
+    job = await load_job(job_id)
+
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    
-    job = analysis_jobs[job_id]
-    
-    # Delete files
-    for path_key in ['input_path', 'output_path', 'results_path']:
+
+    # Delete files without blocking the event loop on slow storage
+    for path_key in ['input_path', 'output_path', 'results_path', 'keypoints_path']:
         path = job.get(path_key)
-        if path and os.path.exists(path):
+        if path and await aiofiles.os.path.exists(path):
             try:
-                os.remove(path)
+                await aiofiles.os.remove(path)
                 logger.info(f"Deleted file: {path}")
             except Exception as e:
                 logger.error(f"Error deleting file {path}: {e}")
     
-    # Remove from jobs dictionary
-    del analysis_jobs[job_id]
-    
+    # Remove from the job store
+    await redis_client.delete(_job_key(job_id))
+
     return {"message": f"Job {job_id} deleted successfully"}
 
 
@@ -339,9 +524,12 @@ async def delete_job(job_id: str):
 async def list_jobs():
     
     jobs_list = []
-    for job_id, job in analysis_jobs.items():
+    async for key in redis_client.scan_iter(match="job:*"):
+        job = await redis_client.hgetall(key)
+        if not job:
+            continue
         jobs_list.append({
-            'job_id': job_id,
+            'job_id': job['job_id'],
             'status': job['status'],
             'created_at': job['created_at'],
             'input_filename': job.get('input_filename')
@@ -3,41 +3,144 @@
 import cv2
 import mediapipe as mp
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 from typing import Tuple, Optional, List
 import logging
+import os
+import queue
+import threading
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Landmark names resolved once; indexing a tuple avoids constructing a
+# PoseLandmark enum instance per landmark during serialization
+_LANDMARK_NAMES = tuple(lm.name for lm in mp.solutions.pose.PoseLandmark)
+
+
+# Process-wide Pose cache: keeping instances across jobs amortizes the
+# several-hundred-ms TFLite graph load. Evicted instances are close()d
+# rather than left for GC, and confidences are rounded so client-supplied
+# floats map onto a bounded key space instead of churning the cache.
+_POSE_CACHE_SIZE = 8
+_pose_cache = {}
+_pose_cache_lock = threading.Lock()
+
+
+def _get_pose(min_detection_confidence: float,
+              min_tracking_confidence: float,
+              model_complexity: int,
+              static_image_mode: bool):
+    """
+    Return a process-wide (Pose, Lock) pair for the given settings.
+
+    The per-instance lock serializes use, since a Pose instance is not
+    thread-safe.
+    """
+    key = (
+        round(min_detection_confidence, 2),
+        round(min_tracking_confidence, 2),
+        model_complexity,
+        static_image_mode
+    )
+
+    with _pose_cache_lock:
+        entry = _pose_cache.pop(key, None)
+        if entry is None:
+            pose = mp.solutions.pose.Pose(
+                static_image_mode=static_image_mode,
+                min_detection_confidence=key[0],
+                min_tracking_confidence=key[1],
+                model_complexity=model_complexity
+            )
+            entry = (pose, threading.Lock())
+
+        # Reinsert as most recently used, then close the oldest entries
+        # once they fall out of the cache
+        _pose_cache[key] = entry
+        while len(_pose_cache) > _POSE_CACHE_SIZE:
+            old_pose, old_lock = _pose_cache.pop(next(iter(_pose_cache)))
+            with old_lock:
+                old_pose.close()
+
+        return entry
+
+
+def _create_video_writer(output_path: str, fps: int, frame_size: Tuple[int, int]) -> cv2.VideoWriter:
+    """
+    Open a VideoWriter for output_path, preferring a hardware H.264 encoder
+    (e.g. nvh264enc, vaapih264enc) via GStreamer when ANALYZER_HW_ENCODER is
+    set, and falling back to the mp4v software encoder otherwise
+    """
+    encoder = os.getenv("ANALYZER_HW_ENCODER")
+    if encoder:
+        pipeline = (
+            f"appsrc ! videoconvert ! {encoder} ! h264parse ! "
+            f"mp4mux ! filesink location={output_path}"
+        )
+        writer = cv2.VideoWriter(pipeline, cv2.CAP_GSTREAMER, 0, fps, frame_size)
+        if writer.isOpened():
+            return writer
+        logger.warning(f"GStreamer encoder '{encoder}' unavailable, falling back to mp4v")
+
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    return cv2.VideoWriter(output_path, fourcc, fps, frame_size)
+
 
 class DanceMovementAnalyzer:
    
-    def __init__(self, 
+    def __init__(self,
                  min_detection_confidence: float = 0.5,
-                 min_tracking_confidence: float = 0.5):
-        
+                 min_tracking_confidence: float = 0.5,
+                 model_complexity: Optional[int] = None,
+                 static_image_mode: bool = False):
+
+        # 2 is the most accurate BlazePose variant; 1 or 0 select the
+        # smaller, roughly 2x-faster models (overridable per deployment
+        # via ANALYZER_MODEL_COMPLEXITY)
+        if model_complexity is None:
+            model_complexity = int(os.getenv("ANALYZER_MODEL_COMPLEXITY", 2))
+
         self.mp_pose = mp.solutions.pose
-        self.mp_drawing = mp.solutions.drawing_utils
-        self.mp_drawing_styles = mp.solutions.drawing_styles
-        
-        self.pose = self.mp_pose.Pose(
-            min_detection_confidence=min_detection_confidence,
-            min_tracking_confidence=min_tracking_confidence,
-            model_complexity=2  # Use the most accurate model
+
+        # Pose connections as an (E, 2) index array so the whole skeleton
+        # can be drawn with one polylines call instead of per-edge Python
+        self._connections = np.array(sorted(self.mp_pose.POSE_CONNECTIONS), dtype=np.int32)
+
+        # static_image_mode=True runs the detector on every input instead of
+        # the stateful tracker; use it when feeding unrelated single frames
+        self.pose, self._pose_lock = _get_pose(
+            min_detection_confidence,
+            min_tracking_confidence,
+            model_complexity,
+            static_image_mode
         )
-        
-        self.keypoint_data = []
-        
-    def process_video(self, 
-                     input_path: str, 
+
+        # Landmarks are stored as one (33, 4) float32 array per detected
+        # frame (columns x, y, z, visibility) with frame numbers alongside;
+        # dict views are only built at the serialization boundary
+        self._keypoints = []
+        self._keypoint_frames = []
+
+    def process_video(self,
+                     input_path: str,
                      output_path: str,
-                     draw_skeleton: bool = True) -> dict:
-        
+                     *,
+                     draw_skeleton: bool = True,
+                     frame_skip: int = 1,
+                     emit_skeleton_only: bool = True,
+                     max_frames: Optional[int] = None) -> dict:
+
         logger.info(f"Processing video: {input_path}")
+
+        if frame_skip < 1:
+            frame_skip = 1
         
-        # Open video file
-        cap = cv2.VideoCapture(input_path)
+        # Open video file; hardware-accelerated decode can be requested via
+        # the OPENCV_FFMPEG_CAPTURE_OPTIONS env var (e.g. "hwaccel;cuda")
+        cap = cv2.VideoCapture(input_path, cv2.CAP_FFMPEG)
         if not cap.isOpened():
             raise ValueError(f"Cannot open video file: {input_path}")
         
@@ -49,162 +152,282 @@ class DanceMovementAnalyzer:
         
         logger.info(f"Video properties - FPS: {fps}, Size: {width}x{height}, Frames: {total_frames}")
         
-        # Initialize video writers for BOTH outputs
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        out_overlay = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
-        
-        # Create skeleton-only output path
-        skeleton_only_path = output_path.replace('.mp4', '_skeleton_only.mp4')
-        out_skeleton = cv2.VideoWriter(skeleton_only_path, fourcc, fps, (width, height))
+        # Initialize video writers
+        out_overlay = _create_video_writer(output_path, fps, (width, height))
+
+        # Create skeleton-only output when requested
+        skeleton_only_path = None
+        out_skeleton = None
+        if emit_skeleton_only:
+            skeleton_only_path = output_path.replace('.mp4', '_skeleton_only.mp4')
+            out_skeleton = _create_video_writer(skeleton_only_path, fps, (width, height))
         
         frame_count = 0
+        inferred_frames = 0
         detected_frames = 0
-        self.keypoint_data = []
-        
+        self._keypoints = []
+        self._keypoint_frames = []
+
+        # Preallocate the RGB buffer and skeleton canvas once; cvtColor
+        # writes into its buffer every frame and the canvas is re-zeroed
+        # in place instead of allocating fresh H x W x 3 arrays per iteration
+        rgb_frame = np.empty((height, width, 3), dtype=np.uint8)
+        skeleton_frame = np.zeros((height, width, 3), dtype=np.uint8)
+        skeleton_dirty = False
+
+        # Decode on a producer thread so demux/decode overlaps with pose
+        # inference; the bounded queue applies backpressure to the reader
+        frame_queue = queue.Queue(maxsize=8)
+        stop_reading = threading.Event()
+
+        def _read_frames():
+            try:
+                while not stop_reading.is_set():
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
+                    while not stop_reading.is_set():
+                        try:
+                            frame_queue.put(frame, timeout=0.5)
+                            break
+                        except queue.Full:
+                            pass
+            finally:
+                while not stop_reading.is_set():
+                    try:
+                        frame_queue.put(None, timeout=0.5)
+                        break
+                    except queue.Full:
+                        pass
+
+        # Pose tracking is stateful across frames and the instance is shared
+        # between jobs, so hold its lock for the whole video
+        self._pose_lock.acquire()
+
+        reader = threading.Thread(target=_read_frames, daemon=True)
+        reader.start()
+
         try:
-            while cap.isOpened():
-                ret, frame = cap.read()
-                if not ret:
+            while True:
+                # Stop early when a frame budget is set (e.g. smoke runs)
+                if max_frames is not None and frame_count >= max_frames:
                     break
+
+                frame = frame_queue.get()
+                if frame is None:
+                    break
+
+                # Run pose inference on every frame_skip-th frame;
+                # skipped frames are written through unannotated
+                results = None
+                if frame_count % frame_skip == 0:
+                    inferred_frames += 1
+                    # Convert BGR to RGB for MediaPipe
+                    cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=rgb_frame)
+                    results = self.pose.process(rgb_frame)
                 
-                # Convert BGR to RGB for MediaPipe
-                rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                
-                # Process ALL frames (continuous, no skipping)
-                results = self.pose.process(rgb_frame)
-                
-                # Create skeleton-only frame (black background)
-                skeleton_frame = np.zeros_like(frame)
-                
+                # Reset the skeleton canvas only if the last frame drew on it
+                if skeleton_dirty:
+                    skeleton_frame.fill(0)
+                    skeleton_dirty = False
+
                 # Draw skeleton if pose detected
                 if results and results.pose_landmarks:
                     detected_frames += 1
-                    
+                    landmarks = self._extract_keypoints(results.pose_landmarks)
+
                     if draw_skeleton:
-                        # Draw pose landmarks on original frame (overlay)
-                        self.mp_drawing.draw_landmarks(
-                            frame,
-                            results.pose_landmarks,
-                            self.mp_pose.POSE_CONNECTIONS,
-                            landmark_drawing_spec=self.mp_drawing_styles.get_default_pose_landmarks_style()
-                        )
-                        
-                        # Draw pose landmarks on black background (skeleton only)
-                        self.mp_drawing.draw_landmarks(
-                            skeleton_frame,
-                            results.pose_landmarks,
-                            self.mp_pose.POSE_CONNECTIONS,
-                            landmark_drawing_spec=self.mp_drawing_styles.get_default_pose_landmarks_style()
-                        )
-                    
+                        # Draw pose landmarks once on the black background;
+                        # the overlay is the frame plus that layer, since
+                        # every pixel outside the skeleton is zero
+                        self._draw_skeleton(skeleton_frame, landmarks, width, height)
+                        cv2.add(frame, skeleton_frame, dst=frame)
+                        skeleton_dirty = True
+
                     # Store keypoint data for this frame
-                    keypoints = self._extract_keypoints(results.pose_landmarks, frame_count)
-                    self.keypoint_data.append(keypoints)
+                    self._keypoints.append(landmarks)
+                    self._keypoint_frames.append(frame_count)
                 
-                # Write frames to BOTH output videos
+                # Write frames to the output videos
                 out_overlay.write(frame)
-                out_skeleton.write(skeleton_frame)
+                if out_skeleton is not None:
+                    out_skeleton.write(skeleton_frame)
                 frame_count += 1
                 
                 if frame_count % 30 == 0:
                     logger.info(f"Processed {frame_count}/{total_frames} frames")
         
         finally:
+            self._pose_lock.release()
+            stop_reading.set()
+            reader.join()
             cap.release()
             out_overlay.release()
-            out_skeleton.release()
-        
-        # Calculate analysis metrics
-        detection_rate = (detected_frames / frame_count * 100) if frame_count > 0 else 0
+            if out_skeleton is not None:
+                out_skeleton.release()
         
+        # Calculate analysis metrics; the rate is over frames actually
+        # submitted to inference so frame_skip does not deflate it
+        detection_rate = (detected_frames / inferred_frames * 100) if inferred_frames > 0 else 0
+
         analysis_results = {
             'input_file': input_path,
             'output_file': output_path,
             'skeleton_only_file': skeleton_only_path,
             'total_frames': frame_count,
+            'inferred_frames': inferred_frames,
             'detected_frames': detected_frames,
             'detection_rate': detection_rate,
             'fps': fps,
             'resolution': (width, height),
-            'keypoint_frames': len(self.keypoint_data)
+            'keypoint_frames': len(self._keypoints)
         }
         
         logger.info(f"Processing complete - Detection rate: {detection_rate:.2f}%")
         logger.info(f"Output files: {output_path} and {skeleton_only_path}")
         return analysis_results
     
-    def _extract_keypoints(self, pose_landmarks, frame_number: int) -> dict:
-        
-        keypoints = {
-            'frame': frame_number,
-            'landmarks': []
-        }
-        
-        for idx, landmark in enumerate(pose_landmarks.landmark):
-            keypoints['landmarks'].append({
-                'id': idx,
-                'name': self.mp_pose.PoseLandmark(idx).name,
-                'x': landmark.x,
-                'y': landmark.y,
-                'z': landmark.z,
-                'visibility': landmark.visibility
-            })
-        
-        return keypoints
-    
+    def _draw_skeleton(self,
+                       canvas: np.ndarray,
+                       landmarks: np.ndarray,
+                       width: int,
+                       height: int,
+                       visibility_threshold: float = 0.5):
+        """
+        Draw all pose connections with one polylines call and the joints
+        with filled circles, skipping landmarks below the visibility threshold
+        """
+        pts = (landmarks[:, :2] * (width, height)).astype(np.int32)
+        visible = landmarks[:, 3] >= visibility_threshold
+
+        segments = self._connections[np.all(visible[self._connections], axis=1)]
+        if len(segments):
+            cv2.polylines(canvas, pts[segments], False, (0, 255, 0), 2)
+
+        for x, y in pts[visible]:
+            cv2.circle(canvas, (int(x), int(y)), 3, (0, 0, 255), -1)
+
+    def _extract_keypoints(self, pose_landmarks) -> np.ndarray:
+
+        return np.array(
+            [(lm.x, lm.y, lm.z, lm.visibility) for lm in pose_landmarks.landmark],
+            dtype=np.float32
+        )
+
     def get_movement_statistics(self) -> dict:
-      
-        if not self.keypoint_data:
+
+        if not self._keypoints:
             return {'error': 'No keypoint data available'}
-        
-        # Calculate average visibility across all frames
-        total_visibility = 0
-        landmark_count = 0
-        
-        for frame_data in self.keypoint_data:
-            for landmark in frame_data['landmarks']:
-                total_visibility += landmark['visibility']
-                landmark_count += 1
-        
-        avg_visibility = total_visibility / landmark_count if landmark_count > 0 else 0
-        
-        # Calculate movement range (simplified - based on hand movements)
+
+        # All aggregates are single NumPy reductions over the stacked
+        # (N, 33, 4) array; there is no Python-level hot loop left here
+        arr = self.get_keypoint_data_array()
+        avg_visibility = float(arr[:, :, 3].mean())
+        per_joint_visibility = arr[:, :, 3].mean(axis=0)
+        per_joint_depth = arr[:, :, 2].mean(axis=0)
+
         movement_stats = {
-            'total_frames_analyzed': len(self.keypoint_data),
+            'total_frames_analyzed': len(self._keypoints),
             'average_visibility': avg_visibility,
-            'pose_detected': len(self.keypoint_data) > 0
+            'per_joint_average_visibility': {
+                _LANDMARK_NAMES[idx]: float(v)
+                for idx, v in enumerate(per_joint_visibility)
+            },
+            'per_joint_average_depth': {
+                _LANDMARK_NAMES[idx]: float(z)
+                for idx, z in enumerate(per_joint_depth)
+            },
+            'pose_detected': True
         }
-        
+
         return movement_stats
-    
+
     def get_keypoint_data(self) -> List[dict]:
         """
         Get raw keypoint data from analysis
-        
+
         Returns:
             List of keypoint dictionaries for each frame
         """
-        return self.keypoint_data
+        keypoint_data = []
+        for frame_number, landmarks in zip(self._keypoint_frames, self._keypoints):
+            keypoint_data.append({
+                'frame': frame_number,
+                'landmarks': [
+                    {
+                        'id': idx,
+                        'name': _LANDMARK_NAMES[idx],
+                        'x': float(x),
+                        'y': float(y),
+                        'z': float(z),
+                        'visibility': float(visibility)
+                    }
+                    for idx, (x, y, z, visibility) in enumerate(landmarks)
+                ]
+            })
+        return keypoint_data
     
+    def get_keypoint_data_array(self) -> np.ndarray:
+        """
+        Get keypoints as a single (num_frames, 33, 4) float32 array with
+        columns x, y, z, visibility; empty when no pose was detected
+        """
+        if not self._keypoints:
+            return np.empty((0, 33, 4), dtype=np.float32)
+        return np.stack(self._keypoints)
+
+    def save_keypoints(self, path: str):
+        """
+        Write the extracted keypoints as a columnar Parquet file with one
+        row per (frame, landmark): far smaller than JSON dicts and directly
+        queryable by analytics tools
+        """
+        if self._keypoints:
+            arr = np.stack(self._keypoints)
+            num_frames, num_landmarks, _ = arr.shape
+            frames = np.repeat(np.asarray(self._keypoint_frames, dtype=np.int32), num_landmarks)
+            landmark_ids = np.tile(np.arange(num_landmarks, dtype=np.int8), num_frames)
+            flat = arr.reshape(-1, 4)
+        else:
+            frames = np.empty(0, dtype=np.int32)
+            landmark_ids = np.empty(0, dtype=np.int8)
+            flat = np.empty((0, 4), dtype=np.float32)
+
+        table = pa.table({
+            'frame': frames,
+            'landmark_id': landmark_ids,
+            'x': flat[:, 0],
+            'y': flat[:, 1],
+            'z': flat[:, 2],
+            'visibility': flat[:, 3]
+        })
+        pq.write_table(table, path, compression='zstd')
+        logger.info(f"Keypoints written to {path} ({table.num_rows} rows)")
+
     def cleanup(self):
-        """Release resources"""
-        self.pose.close()
+        """Release per-job resources; the shared Pose instance stays cached"""
+        pass
 
 
-def analyze_dance_video(input_path: str, 
+def analyze_dance_video(input_path: str,
                        output_path: str,
                        min_detection_confidence: float = 0.5,
-                       min_tracking_confidence: float = 0.5) -> dict:
-   
+                       min_tracking_confidence: float = 0.5,
+                       keypoints_path: Optional[str] = None,
+                       frame_skip: int = 1) -> dict:
+
     analyzer = DanceMovementAnalyzer(
         min_detection_confidence=min_detection_confidence,
         min_tracking_confidence=min_tracking_confidence
     )
-    
+
     try:
-        results = analyzer.process_video(input_path, output_path)
+        results = analyzer.process_video(input_path, output_path, frame_skip=frame_skip)
         movement_stats = analyzer.get_movement_statistics()
         results['movement_statistics'] = movement_stats
+        if keypoints_path:
+            analyzer.save_keypoints(keypoints_path)
+            results['keypoints_file'] = keypoints_path
         return results
     finally:
         analyzer.cleanup()